@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import streamlit as st
 import plotly.express as px
@@ -7,26 +8,95 @@ st.set_page_config(page_title="Finance Tracker", layout="wide")
 
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 LEDGER_CSV = PROJECT_ROOT / "data" / "processed" / "ledger.csv"
+LEDGER_DIR = LEDGER_CSV.with_suffix("")  # partições parquet: ledger/*.parquet
+LEDGER_CSV_DTYPES = {
+    "tx_id": "string",
+    "external_id": "string",
+    "source": "category",
+    "type": "category",
+    "category": "category",
+    "subcategory": "category",
+    "description": "string",
+    "file_name": "string",
+    "amount": "float64",
+}
 
 st.title("Finance Tracker — Nubank + Itaú")
 st.caption("Dashboard local. Seus dados ficam no seu computador.")
 
-if not LEDGER_CSV.exists():
-    st.error("Não encontrei data/processed/ledger.csv. Rode os importadores primeiro.")
+if not any(LEDGER_DIR.glob("*.parquet")) and not LEDGER_CSV.exists():
+    st.error("Não encontrei data/processed/ledger/ nem ledger.csv. Rode os importadores primeiro.")
     st.stop()
 
-@st.cache_data
-def load_ledger(path: Path) -> pd.DataFrame:
-    df = pd.read_csv(path, dtype={"tx_id": "string", "external_id": "string"})
-    df["date"] = pd.to_datetime(df["date"], errors="coerce")
-    df["description"] = df["description"].astype(str).str.strip()
-    df["source"] = df["source"].astype(str).str.strip().str.lower()
-    df["type"] = df["type"].astype(str).str.strip().str.lower()
-
-    # garante colunas opcionais
+def read_ledger_csv(path: Path) -> pd.DataFrame:
+    # pyarrow lê o CSV em paralelo (blocos por thread); pandas só como fallback
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pac
+    except ImportError:
+        pa = None
+
+    if pa is not None:
+        arrow_types = {
+            "string": pa.string(),
+            "category": pa.dictionary(pa.int32(), pa.string()),
+            "float64": pa.float64(),
+        }
+        column_types = {c: arrow_types[t] for c, t in LEDGER_CSV_DTYPES.items()}
+        column_types["date"] = pa.timestamp("ns")
+        try:
+            # strings_can_be_null: célula vazia vira NaN (como no pandas), não ""
+            opts = pac.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+            table = pac.read_csv(path, convert_options=opts)
+            return table.to_pandas()
+        except pa.ArrowInvalid:
+            pass  # ex.: data inválida; pandas converte com coerce
+
+    # schema completo: evita inferência de tipos e os casts posteriores
+    return pd.read_csv(path, dtype=LEDGER_CSV_DTYPES, parse_dates=["date"], engine="c")
+
+def ledger_signature(path: Path) -> tuple:
+    # só nomes + mtime dos arquivos: chave barata pro cache, muda a cada import
+    files = [path, *sorted(path.with_suffix("").glob("*.parquet"))]
+    return tuple((p.name, p.stat().st_mtime_ns) for p in files if p.exists())
+
+# cache_resource devolve sempre o mesmo objeto (sem pickle/cópia a cada rerun):
+# quem usa o resultado não deve modificá-lo
+@st.cache_resource(max_entries=1)
+def load_ledger(path: Path, signature: tuple) -> pd.DataFrame:
+    # partições parquet são a fonte de verdade (já vêm com datetime); CSV só como fallback
+    parts = sorted(path.with_suffix("").glob("*.parquet"))
+    if parts:
+        # nomes <seq>_... ordenados = ordem de import (linha mais antiga vence no dedup)
+        df = pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True)
+    else:
+        df = read_ledger_csv(path)
+        if not pd.api.types.is_datetime64_any_dtype(df["date"]):
+            # alguma data inválida: read_csv devolve texto, converte com coerce
+            df["date"] = pd.to_datetime(df["date"], errors="coerce")
+    # importadores só fazem append; dedup por tx_id acontece aqui
+    df = df.drop_duplicates(subset=["tx_id"], keep="first")
+    df["description"] = df["description"].str.strip()
+
+    # garante colunas opcionais (partições sem regras aplicadas não as têm)
     for col in ["category", "subcategory"]:
         if col not in df.columns:
             df[col] = "Uncategorized"
+        elif df[col].isna().any():
+            df[col] = df[col].astype(object).fillna("Uncategorized")
+
+    # categóricas: isin/groupby trabalham nos códigos inteiros, não em strings
+    for col in ["source", "type", "category", "subcategory"]:
+        df[col] = df[col].astype("category")
+
+    # normaliza source/type só nas categorias (poucas), não linha a linha
+    for col in ["source", "type"]:
+        norm = {c: str(c).strip().lower() for c in df[col].cat.categories}
+        df[col] = df[col].map(norm).astype("category")
+
+    # gastos/recebimentos mascarados: agregação mensal só com "sum" nativo
+    df["_neg"] = df["amount"].where(df["amount"] < 0, 0.0)
+    df["_pos"] = df["amount"].where(df["amount"] > 0, 0.0)
 
     # mês (YYYY-MM)
     df["month"] = df["date"].dt.to_period("M").astype(str)
@@ -37,9 +107,11 @@ def load_ledger(path: Path) -> pd.DataFrame:
         .str.replace(r"\s+", " ", regex=True)
         .str.slice(0, 60)
     )
+    # minúsculas calculadas uma vez (busca por texto roda a cada interação)
+    df["desc_lower"] = df["description"].str.lower()
     return df.dropna(subset=["date", "amount"])
 
-df = load_ledger(LEDGER_CSV)
+df = load_ledger(LEDGER_CSV, ledger_signature(LEDGER_CSV))
 
 # ---------------- Sidebar filtros ----------------
 st.sidebar.header("Filtros")
@@ -68,15 +140,20 @@ sel_types = st.sidebar.multiselect("Tipos", types, default=types)
 text_filter = st.sidebar.text_input("Buscar na descrição (contém)", value="").strip().lower()
 
 # aplica filtros
-f = df[
-    (df["date"].dt.date >= start_date) &
-    (df["date"].dt.date <= end_date) &
-    (df["source"].isin(sel_sources)) &
-    (df["type"].isin(sel_types))
-].copy()
+# máscara em numpy: compara datetime64 direto, sem materializar datetime.date por linha
+dates = df["date"].to_numpy()
+start64 = np.datetime64(start_date)
+end64 = np.datetime64(end_date) + np.timedelta64(1, "D")
+mask = (
+    (dates >= start64) &
+    (dates < end64) &
+    df["source"].isin(sel_sources).to_numpy() &
+    df["type"].isin(sel_types).to_numpy()
+)
+f = df[mask]
 
 if text_filter:
-    f = f[f["description"].str.lower().str.contains(text_filter, na=False)]
+    f = f[f["desc_lower"].str.contains(text_filter, na=False, regex=False)]
 
 # ---------------- KPIs ----------------
 total_expense = f.loc[f["amount"] < 0, "amount"].sum()
@@ -101,8 +178,8 @@ g1, g2 = st.columns(2)
 with g1:
     st.subheader("Evolução mensal (saldo, gastos, recebimentos)")
     by_month = f.groupby("month", as_index=False).agg(
-        gastos=("amount", lambda s: s[s < 0].sum()),
-        receb=("amount", lambda s: s[s > 0].sum()),
+        gastos=("_neg", "sum"),
+        receb=("_pos", "sum"),
         saldo=("amount", "sum"),
     )
     fig = px.line(by_month, x="month", y=["gastos", "receb", "saldo"])
@@ -110,17 +187,17 @@ with g1:
 
 with g2:
     st.subheader("Gastos por fonte")
-    by_source = f.loc[f["amount"] < 0].groupby("source", as_index=False)["amount"].sum()
+    by_source = f.loc[f["amount"] < 0].groupby("source", as_index=False, observed=True)["amount"].sum()
     fig2 = px.bar(by_source, x="source", y="amount")
     st.plotly_chart(fig2, use_container_width=True)
 
 g3, g4 = st.columns(2)
 
 st.subheader("Gastos por categoria (somente expense)")
-gastos = f[(f["type"] == "expense") & (f["amount"] < 0)].copy()
+gastos = f[(f["type"] == "expense") & (f["amount"] < 0)]
 
 by_cat = (
-    gastos.groupby("category", as_index=False)["amount"]
+    gastos.groupby("category", as_index=False, observed=True)["amount"]
     .sum()
     .sort_values("amount")
 )
@@ -144,13 +221,13 @@ with g3:
 
 with g4:
     st.subheader("Distribuição por tipo")
-    t = f.groupby("type", as_index=False)["amount"].sum()
+    t = f.groupby("type", as_index=False, observed=True)["amount"].sum()
     fig4 = px.bar(t, x="type", y="amount")
     st.plotly_chart(fig4, use_container_width=True)
 
     st.subheader("Transferências (saídas)")
-    tr = f[(f["type"] == "transfer") & (f["amount"] < 0)].copy()
-    by_tr = tr.groupby("category", as_index=False)["amount"].sum().sort_values("amount")
+    tr = f[(f["type"] == "transfer") & (f["amount"] < 0)]
+    by_tr = tr.groupby("category", as_index=False, observed=True)["amount"].sum().sort_values("amount")
     fig_tr = px.bar(by_tr, x="amount", y="category", orientation="h")
     st.plotly_chart(fig_tr, use_container_width=True)
 
@@ -162,17 +239,21 @@ st.subheader("Transações (filtradas)")
 show_cols = ["date", "source", "type", "description", "amount", "category", "subcategory", "external_id", "tx_id", "file_name"]
 show_cols = [c for c in show_cols if c in f.columns]
 
+f_sorted = f.sort_values("date", ascending=False)
+
 st.dataframe(
-    f.sort_values("date", ascending=False)[show_cols],
+    f_sorted[show_cols],
     use_container_width=True,
     height=450,
 )
 
-csv_bytes = f.sort_values("date", ascending=False).to_csv(index=False, encoding="utf-8").encode("utf-8")
+def to_csv_bytes(frame: pd.DataFrame) -> bytes:
+    return frame.drop(columns=["_neg", "_pos", "desc_lower"]).to_csv(index=False, encoding="utf-8").encode("utf-8")
+
+# callable: o CSV só é gerado no clique (senão seria recodificado a cada interação)
 st.download_button(
     "Baixar CSV (filtrado)",
-    data=csv_bytes,
+    data=lambda: to_csv_bytes(f_sorted),
     file_name="ledger_filtrado.csv",
     mime="text/csv"
 )
-
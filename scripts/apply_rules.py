@@ -1,64 +1,266 @@
+import functools
 import re
+import warnings
 from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
 import pandas as pd
 
+try:
+    import ahocorasick  # pyahocorasick (opcional): pré-filtro de regras literais
+except ImportError:
+    ahocorasick = None
+
 
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 RULES_PATH = PROJECT_ROOT / "rules" / "rules.csv"
+CATEGORICAL_COLS = ["source", "type", "category", "subcategory"]
+VALID_HINTS = {"expense", "income", "transfer", "investment"}
+REGEX_METACHARS = set(".^$*+?{}[]\\|()")
+# backreferences numeradas/nomeadas e grupos nomeados mudam de sentido na regex combinada
+GROUP_REF_RE = re.compile(r"\\[1-9]|\\g<|\(\?P[<=]")
+
+
+def _literal_keywords(pattern: str) -> Optional[List[str]]:
+    """
+    Se a regra for só uma alternância de literais (ex.: NETFLIX|SPOTIFY),
+    devolve as palavras em minúsculas; senão None (regra de regex de verdade).
+    """
+    words = pattern.split("|")
+    if any(not w or REGEX_METACHARS & set(w) for w in words):
+        return None
+    return [w.lower() for w in words]
+
+
+class CompiledRules(NamedTuple):
+    """
+    Regras prontas pra aplicar; índice = prioridade (0 vence).
+    `regex` cobre as regras que não foram pro `automaton`, exceto as que
+    não podem ser fundidas numa regex só (`singles`, testadas uma a uma).
+    """
+    regex: Optional[re.Pattern]
+    regex_idx: np.ndarray
+    singles: Tuple[Tuple[int, re.Pattern], ...]
+    automaton: Optional["ahocorasick.Automaton"]
+    cats: np.ndarray
+    subs: np.ndarray
+    hints: np.ndarray
+
+
+def _combined_pattern(patterns: Dict[int, str]) -> str:
+    """
+    Junta as regras numa única regex com grupos nomeados (r<prioridade>).
+    Cada regra é um lookahead ancorado no início: a primeira alternativa que casar
+    (ordem de prioridade) vence, independente da posição do match na descrição.
+    O DOTALL fica só no prefixo: o "." das regras continua sem casar quebra de linha.
+    """
+    alts = "|".join(f"(?=(?s:.*?)(?P<r{i}>{p}))" for i, p in patterns.items())
+    return f"^(?:{alts})"
 
 
-def load_rules(path: Path) -> pd.DataFrame:
+def _fusable(pattern: str) -> bool:
+    """
+    A regra pode entrar na regex combinada? Flags inline (ex.: (?i)) e
+    backreferences (ex.: (A)\\1) só funcionam compiladas sozinhas.
+    """
+    if GROUP_REF_RE.search(pattern):
+        return False
+    try:
+        re.compile(_combined_pattern({0: pattern}), re.I)
+    except re.error:
+        return False
+    return True
+
+
+def _build_automaton(keywords: Dict[int, List[str]]) -> "ahocorasick.Automaton":
+    automaton = ahocorasick.Automaton()
+    for i, words in keywords.items():
+        for w in words:
+            # mesma palavra em várias regras: fica a de maior prioridade
+            if w not in automaton:
+                automaton.add_word(w, i)
+    automaton.make_automaton()
+    return automaton
+
+
+@functools.lru_cache(maxsize=1)
+def _compile_rules(path: Path, mtime_ns: int) -> CompiledRules:
+    # mtime_ns só entra na chave do cache: editou rules.csv, recompila
+    # (maxsize=1: a versão anterior sai do cache, não acumula a cada edição)
     rules = pd.read_csv(path)
     rules["priority"] = pd.to_numeric(rules["priority"], errors="coerce").fillna(9999).astype(int)
     rules = rules.sort_values("priority")
-    # compila regex (case-insensitive)
-    rules["regex"] = rules["pattern"].astype(str).apply(lambda p: re.compile(p, re.I))
-    return rules
 
+    empty = pd.Series("", index=rules.index)
+    patterns: Dict[int, str] = {}
+    singles: List[Tuple[int, re.Pattern]] = []
+    keywords: Dict[int, List[str]] = {}
+    cats: List[str] = []
+    subs: List[str] = []
+    hints: List[str] = []
+    for pattern, cat, sub, hint in zip(
+        rules["pattern"].astype(str),
+        rules.get("category", empty),
+        rules.get("subcategory", empty),
+        rules.get("type_hint", empty),
+    ):
+        cat = str(cat).strip()
+        if not cat:
+            continue
+        sub = str(sub).strip()
+        hint = str(hint).strip().lower()
+
+        # padrão inválido sozinho continua sendo erro (como sempre foi)
+        rx = re.compile(pattern, re.I)
 
-def apply_rules(df: pd.DataFrame, rules: pd.DataFrame) -> pd.DataFrame:
+        i = len(cats)
+        # regras literais vão pro Aho-Corasick; o resto continua como regex
+        words = _literal_keywords(pattern)
+        if words and ahocorasick is not None:
+            keywords[i] = words
+        elif _fusable(pattern):
+            patterns[i] = pattern
+        else:
+            singles.append((i, rx))
+        cats.append(cat)
+        subs.append(sub if sub else cat)
+        hints.append(hint if hint in VALID_HINTS else "")
+
+    return CompiledRules(
+        regex=re.compile(_combined_pattern(patterns), re.I) if patterns else None,
+        regex_idx=np.array(list(patterns), dtype=np.int64),
+        singles=tuple(singles),
+        automaton=_build_automaton(keywords) if keywords else None,
+        cats=np.array(cats, dtype=object),
+        subs=np.array(subs, dtype=object),
+        hints=np.array(hints, dtype=object),
+    )
+
+
+def load_rules(path: Path) -> CompiledRules:
+    """
+    Lê e compila rules.csv. Cacheado por (caminho, mtime): chamadas repetidas
+    não relêem nem recompilam enquanto o arquivo não mudar.
+    """
+    path = Path(path).resolve()
+    return _compile_rules(path, path.stat().st_mtime_ns)
+
+
+def _literal_best(desc: pd.Series, automaton: "ahocorasick.Automaton", default: int) -> np.ndarray:
+    """
+    Uma varredura Aho-Corasick por descrição: menor índice (maior prioridade)
+    entre as regras literais que aparecem no texto; `default` se nenhuma.
+    """
+    best = np.full(len(desc), default, dtype=np.int64)
+    for row, text in enumerate(desc.str.lower()):
+        for _, i in automaton.iter(text):
+            if i < best[row]:
+                best[row] = i
+    return best
+
+
+def apply_rules(df: pd.DataFrame, rules: CompiledRules) -> pd.DataFrame:
     df = df.copy()
     if "category" not in df.columns:
         df["category"] = "Uncategorized"
     if "subcategory" not in df.columns:
         df["subcategory"] = "Uncategorized"
+    # categóricas (vindas do parquet) não aceitam valores novos; volta pra texto
+    for col in ("category", "subcategory", "type"):
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
 
-    desc = df["description"].astype(str)
+    n = len(rules.cats)
+    if not n:
+        return df
 
-    for _, r in rules.iterrows():
-        rx = r["regex"]
-        cat = str(r.get("category", "")).strip()
-        sub = str(r.get("subcategory", "")).strip()
-        hint = str(r.get("type_hint", "")).strip().lower()
+    # índice (prioridade) da regra vencedora por linha; n = nenhuma
+    desc = df["description"].astype(str).fillna("")
+    best = np.full(len(df), n, dtype=np.int64)
+    if rules.automaton is not None:
+        best = _literal_best(desc, rules.automaton, n)
+    if rules.regex is not None:
+        # uma passada só: primeira regra regex (em prioridade) que casou
+        hits = desc.str.extract(rules.regex, expand=True)
+        matched = hits[[f"r{i}" for i in rules.regex_idx]].notna().to_numpy()
+        regex_best = rules.regex_idx[matched.argmax(axis=1)]
+        best = np.minimum(best, np.where(matched.any(axis=1), regex_best, n))
+    for i, rx in rules.singles:
+        # regras que não cabem na regex combinada: uma passada cada
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)  # aviso de grupos no padrão
+            m = desc.str.contains(rx, regex=True, na=False).to_numpy()
+        best = np.where(m & (best > i), i, best)
 
-        if not cat:
-            continue
+    # só aplica se ainda estiver sem categoria
+    uncategorized = df["category"].isin(["Uncategorized", ""]) | df["category"].isna()
+    m = (best < n) & uncategorized.to_numpy()
+    winner = best[m]
+
+    # escreve em arrays e atribui cada coluna uma vez (sem setitem via .loc)
+    cat_arr = df["category"].to_numpy(dtype=object, copy=True)
+    sub_arr = df["subcategory"].to_numpy(dtype=object, copy=True)
+    type_arr = df["type"].to_numpy(dtype=object, copy=True)
 
-        m = desc.apply(lambda x: bool(rx.search(x)))
-        # só aplica se ainda estiver sem categoria (pra respeitar prioridade)
-        m = m & (df["category"].isin(["Uncategorized", "", None]) | df["category"].isna())
+    cat_arr[m] = rules.cats[winner]
+    sub_arr[m] = rules.subs[winner]
 
-        df.loc[m, "category"] = cat
-        df.loc[m, "subcategory"] = sub if sub else cat
+    hint = rules.hints[winner]
+    has_hint = hint != ""
+    type_arr[np.flatnonzero(m)[has_hint]] = hint[has_hint]
 
-        if hint in ["expense", "income", "transfer", "investment"]:
-            df.loc[m, "type"] = hint
+    df["category"] = cat_arr
+    df["subcategory"] = sub_arr
+    df["type"] = type_arr
 
     return df
 
 
+def _to_categorical(df: pd.DataFrame) -> pd.DataFrame:
+    for col in CATEGORICAL_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
+
+
 def main():
-    ledger_path = PROJECT_ROOT / "data" / "processed" / "ledger.csv"
-    if not ledger_path.exists():
-        print("Não encontrei data/processed/ledger.csv")
+    processed = PROJECT_ROOT / "data" / "processed"
+    ledger_path = processed / "ledger.csv"
+    parts = sorted((processed / "ledger").glob("*.parquet"))
+    if not parts and not ledger_path.exists():
+        print("Não encontrei partições em data/processed/ledger/ nem ledger.csv")
         return
 
-    df = pd.read_csv(ledger_path, dtype={"tx_id": "string", "external_id": "string"})
     rules = load_rules(RULES_PATH)
-    out = apply_rules(df, rules)
+
+    if parts:
+        # parquet é a fonte de verdade: aplica regras partição por partição
+        outs = []
+        for part in parts:
+            out = _to_categorical(apply_rules(pd.read_parquet(part), rules))
+            out.to_parquet(part, index=False)
+            outs.append(out)
+        # CSV é só export: regenera já deduplicado
+        out = pd.concat(outs, ignore_index=True).drop_duplicates(subset=["tx_id"], keep="first")
+
+        # nunca sobrescreve um CSV com linhas que as partições não têm
+        if ledger_path.exists():
+            csv_ids = pd.read_csv(ledger_path, usecols=["tx_id"], dtype={"tx_id": "string"})["tx_id"]
+            missing = set(csv_ids.dropna()) - set(out["tx_id"].astype(str))
+            if missing:
+                print(
+                    f"[AVISO] {len(missing)} tx_id(s) do ledger.csv não estão nas partições; "
+                    f"partições atualizadas, ledger.csv mantido: {ledger_path}"
+                )
+                return
+    else:
+        df = pd.read_csv(ledger_path, dtype={"tx_id": "string", "external_id": "string"})
+        df = df.drop_duplicates(subset=["tx_id"], keep="first")
+        out = apply_rules(df, rules)
 
     out.to_csv(ledger_path, index=False, encoding="utf-8")
-    print(f"[OK] Regras aplicadas no ledger: {ledger_path}")
+    print(f"[OK] Regras aplicadas no ledger: {ledger_path} ({len(parts)} partições parquet)")
 
 
 if __name__ == "__main__":
@@ -1,75 +1,75 @@
 from __future__ import annotations
 
+import mmap
 import re
 from pathlib import Path
 from typing import Dict, List, Tuple
 
+import numpy as np
 import pandas as pd
 
 
-def _parse_ofx_sgml(text: str) -> List[Dict[str, str]]:
+CATEGORICAL_COLS = ["source", "type", "category", "subcategory"]
+
+BLOCK_RE = re.compile(rb"<STMTTRN>(.*?)</STMTTRN>", re.S | re.I)
+TAG_RE = re.compile(rb"<(DTPOSTED|TRNAMT|MEMO|NAME|FITID|CHECKNUM|REFNUM)>([^\r\n<]+)", re.I)
+
+
+def _parse_ofx_sgml(path: Path) -> List[Dict[str, str]]:
     """
     Parser simples para OFX (SGML-like). Extrai <STMTTRN>...</STMTTRN>.
     """
-    blocks = re.findall(r"<STMTTRN>(.*?)</STMTTRN>", text, flags=re.S | re.I)
     rows: List[Dict[str, str]] = []
-
-    for b in blocks:
-        def tag(name: str) -> str:
-            m = re.search(rf"<{name}>([^\r\n<]+)", b, flags=re.I)
-            return m.group(1).strip() if m else ""
-
-        dtposted = tag("DTPOSTED")
-        trnamt = tag("TRNAMT")
-        memo = tag("MEMO") or tag("NAME")
-        fitid = tag("FITID")  # às vezes vem vazio no Itaú
-
-        # alguns OFX têm <CHECKNUM> ou <REFNUM> úteis
-        checknum = tag("CHECKNUM")
-        refnum = tag("REFNUM")
-
-        rows.append({
-            "DTPOSTED": dtposted,
-            "TRNAMT": trnamt,
-            "MEMO": memo,
-            "FITID": fitid,
-            "CHECKNUM": checknum,
-            "REFNUM": refnum,
-        })
+    if path.stat().st_size == 0:
+        return rows
+
+    # mmap: regex roda direto nos bytes do arquivo, sem copiar tudo pra uma str
+    with open(path, "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for block in BLOCK_RE.finditer(mm):
+            # uma varredura por bloco; vale a primeira ocorrência de cada tag
+            tags: Dict[str, str] = {}
+            for m in TAG_RE.finditer(block.group(1)):
+                # decodifica só os valores das tags (pequenos)
+                name = m.group(1).decode("ascii").upper()
+                tags.setdefault(name, m.group(2).decode("latin-1").strip())
+
+            dtposted = tags.get("DTPOSTED", "")
+            trnamt = tags.get("TRNAMT", "")
+            memo = tags.get("MEMO", "") or tags.get("NAME", "")
+            fitid = tags.get("FITID", "")  # às vezes vem vazio no Itaú
+
+            # alguns OFX têm <CHECKNUM> ou <REFNUM> úteis
+            checknum = tags.get("CHECKNUM", "")
+            refnum = tags.get("REFNUM", "")
+
+            rows.append({
+                "DTPOSTED": dtposted,
+                "TRNAMT": trnamt,
+                "MEMO": memo,
+                "FITID": fitid,
+                "CHECKNUM": checknum,
+                "REFNUM": refnum,
+            })
 
     return rows
 
 
-def _coerce_date(dtposted: str) -> pd.Timestamp:
-    m = re.match(r"(\d{4})(\d{2})(\d{2})", dtposted or "")
-    if not m:
-        return pd.NaT
-    y, mo, d = m.group(1), m.group(2), m.group(3)
-    return pd.to_datetime(f"{y}-{mo}-{d}", errors="coerce")
-
-
-def _coerce_amount(x: str) -> float:
-    try:
-        return float(str(x).strip())
-    except Exception:
-        return float("nan")
-
-
 def import_itau_ofx(ofx_path: Path) -> pd.DataFrame:
     """
     Lê OFX Itaú e devolve DataFrame padronizado:
     date, description, amount, source, external_id, type, tx_id, file_name
     """
-    text = ofx_path.read_text(encoding="latin-1", errors="ignore")
-    rows = _parse_ofx_sgml(text)
+    rows = _parse_ofx_sgml(ofx_path)
     df = pd.DataFrame(rows)
     if df.empty:
         raise ValueError("Nenhuma transação encontrada no OFX (sem blocos <STMTTRN>).")
 
     out = pd.DataFrame({
-        "date": df["DTPOSTED"].map(_coerce_date),
+        # DTPOSTED: yyyymmdd[hhmmss][...]; formato exato evita inferência lenta
+        "date": pd.to_datetime(df["DTPOSTED"].str[:8], format="%Y%m%d", errors="coerce"),
         "description": df["MEMO"].astype(str).str.strip(),
-        "amount": df["TRNAMT"].map(_coerce_amount),
+        # astype: TRNAMT sem decimais viraria int64 e mudaria o tx_id composto ("-100" vs "-100.0")
+        "amount": pd.to_numeric(df["TRNAMT"].str.strip(), errors="coerce").astype("float64"),
         "source": "itau",
         # external_id: prioriza FITID; senão usa REFNUM/CHECKNUM
         "external_id": (
@@ -88,47 +88,97 @@ def import_itau_ofx(ofx_path: Path) -> pd.DataFrame:
     out.loc[mask_empty, "external_id"] = fallback.loc[mask_empty].astype(str)
 
     out = out.dropna(subset=["date", "amount"])
-    out["type"] = out["amount"].apply(lambda v: "expense" if v < 0 else "income")
+    # códigos int8 (0=income, 1=expense) em vez de strings por linha
+    out["type"] = pd.Categorical.from_codes(
+        (out["amount"].to_numpy() < 0).astype(np.int8), categories=["income", "expense"]
+    )
 
     # tx_id: se external_id útil, usar; senão composto
     key = out["external_id"].fillna("").astype(str)
-    mask_key_empty = key.eq("") | key.eq("|")  # caso REF|CHECK vazio
-    key.loc[mask_key_empty] = (
-        out.loc[mask_key_empty, "date"].astype(str)
-        + "|"
-        + out.loc[mask_key_empty, "description"].astype(str)
-        + "|"
-        + out.loc[mask_key_empty, "amount"].astype(str)
-        + "|itau"
-    )
-    out["tx_id"] = pd.util.hash_pandas_object(key, index=False).astype("uint64").astype(str)
+    mask_key_empty = (key.eq("") | key.eq("|")).to_numpy()  # caso REF|CHECK vazio
+    # composto: mesmo formato de sempre ("date|desc|amount|itau"), pra tx_id
+    # de linhas já gravadas continuar batendo no dedup
+    if mask_key_empty.any():
+        comp = out.loc[mask_key_empty]
+        key.loc[mask_key_empty] = (
+            comp["date"].astype(str)
+            + "|"
+            + comp["description"].astype(str)
+            + "|"
+            + comp["amount"].astype(str)
+            + "|itau"
+        )
+    tx_hash = pd.util.hash_array(key.to_numpy(dtype=object))
+    out["tx_id"] = tx_hash.astype(str)
 
     return out
 
 
-def append_to_ledger(new_df: pd.DataFrame, processed_dir: Path) -> Tuple[Path, Path]:
+def _to_categorical(df: pd.DataFrame) -> pd.DataFrame:
+    for col in CATEGORICAL_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
+
+
+def _seed_partitions(processed_dir: Path, ledger_dir: Path) -> None:
     """
-    Atualiza ledger.csv e ledger.parquet (se possível). Dedup por tx_id (string).
+    Primeiro import no formato particionado: o ledger.csv existente (fonte de
+    verdade até aqui, com categorias aplicadas/editadas) vira a primeira partição.
+    O ledger.parquet antigo só é usado se não houver CSV (ele nunca recebeu categorias).
     """
-    processed_dir.mkdir(parents=True, exist_ok=True)
-    csv_path = processed_dir / "ledger.csv"
-    pq_path = processed_dir / "ledger.parquet"
+    if any(ledger_dir.glob("*.parquet")):
+        return
 
+    csv_path = processed_dir / "ledger.csv"
+    legacy_pq = processed_dir / "ledger.parquet"
     if csv_path.exists():
         old = pd.read_csv(csv_path, dtype={"tx_id": "string", "external_id": "string"})
-        if "date" in old.columns:
-            old["date"] = pd.to_datetime(old["date"], errors="coerce")
-        combined = pd.concat([old, new_df], ignore_index=True)
-        combined["tx_id"] = combined["tx_id"].astype(str)
-        combined = combined.drop_duplicates(subset=["tx_id"], keep="first")
+        old["date"] = pd.to_datetime(old["date"], errors="coerce")
+    elif legacy_pq.exists():
+        old = pd.read_parquet(legacy_pq)
     else:
-        combined = new_df.drop_duplicates(subset=["tx_id"], keep="first")
+        return
+
+    _to_categorical(old).to_parquet(ledger_dir / "000000_legacy.parquet", index=False)
 
-    combined.to_csv(csv_path, index=False, encoding="utf-8")
-    try:
-        combined.to_parquet(pq_path, index=False)
-    except Exception:
-        pass
+
+def append_to_ledger(new_df: pd.DataFrame, processed_dir: Path, part_name: str) -> Tuple[Path, Path]:
+    """
+    Grava só as linhas novas: uma partição parquet em ledger/<seq>_<part_name>.parquet
+    e append no ledger.csv. Linhas cujo tx_id já está no ledger são ignoradas
+    (a existente vence); <seq> crescente mantém a ordem de import na leitura.
+    """
+    ledger_dir = processed_dir / "ledger"
+    ledger_dir.mkdir(parents=True, exist_ok=True)
+    csv_path = processed_dir / "ledger.csv"
+
+    _seed_partitions(processed_dir, ledger_dir)
+
+    parts = sorted(ledger_dir.glob("*.parquet"))
+    seq = max((int(p.name[:6]) for p in parts if p.name[:6].isdigit()), default=0) + 1
+    pq_path = ledger_dir / f"{seq:06d}_{part_name}.parquet"
+
+    # só lê a coluna tx_id das partições existentes
+    seen = set()
+    for part in parts:
+        seen.update(pd.read_parquet(part, columns=["tx_id"])["tx_id"].astype(str))
+    new_df = new_df.drop_duplicates(subset=["tx_id"], keep="first")
+    new_df = new_df[~new_df["tx_id"].astype(str).isin(seen)]
+    if new_df.empty:
+        return csv_path, pq_path
+
+    # partição primeiro e sem engolir erro: CSV nunca fica com linhas que o parquet não tem
+    _to_categorical(new_df.copy()).to_parquet(pq_path, index=False)
+
+    if csv_path.exists():
+        # mantém a ordem de colunas do cabeçalho existente
+        header = pd.read_csv(csv_path, nrows=0).columns
+        new_df.reindex(columns=header).to_csv(
+            csv_path, mode="a", header=False, index=False, encoding="utf-8"
+        )
+    else:
+        new_df.to_csv(csv_path, index=False, encoding="utf-8")
 
     return csv_path, pq_path
 
@@ -152,13 +202,13 @@ def main():
     target = target or files[0]
 
     df = import_itau_ofx(target)
-    csv_path, pq_path = append_to_ledger(df, processed)
+    csv_path, pq_path = append_to_ledger(df, processed, f"itau_{target.stem}")
 
     print(f"[OK] Importado Itaú OFX: {target.name}")
     print(f"[OK] Linhas importadas: {len(df)}")
     print(f"[OK] Ledger atualizado: {csv_path}")
     if pq_path.exists():
-        print(f"[OK] Ledger parquet: {pq_path}")
+        print(f"[OK] Partição parquet: {pq_path}")
 
 
 if __name__ == "__main__":